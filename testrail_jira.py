@@ -7,6 +7,9 @@ import os
 import yaml
 import sys
 import argparse
+import io
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from jira.client import JIRA
 from jira.client import GreenHopper
 
@@ -19,6 +22,8 @@ TEST_SUITE_DAE_ATOM = 1477
 TEST_SUITE_DAE_BMC = 1478
 CI_JIRA_URL = xxx
 testrail_url = xxxxx
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+ATTACHMENT_WORKERS = 8
 
 """
 testrail_jira.log format
@@ -71,6 +76,40 @@ greenhopper = GreenHopper(
 )
 
 
+class AttachmentStream(object):
+    """
+    multipart/form-data body of one attachment, the file is read from disk
+    in chunks while the request is sent instead of loaded into memory
+    """
+    def __init__(self, filepath):
+        self.boundary = uuid.uuid4().hex
+        head = ('--{}\r\nContent-Disposition: form-data; name="attachment"; filename="{}"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n').format(
+                    self.boundary, os.path.basename(filepath)).encode('utf-8')
+        tail = '\r\n--{}--\r\n'.format(self.boundary).encode('utf-8')
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+        self.length = len(head) + os.path.getsize(filepath) + len(tail)
+        self.parts = [io.BytesIO(head), open(filepath, 'rb'), io.BytesIO(tail)]
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        data = b''
+        while self.parts and (size < 0 or len(data) < size):
+            chunk = self.parts[0].read(size - len(data) if size >= 0 else -1)
+            if chunk:
+                data += chunk
+            else:
+                self.parts.pop(0).close()
+        return data
+
+    def close(self):
+        for part in self.parts:
+            part.close()
+        self.parts = []
+
+
 class Testclient(object):
     """
     testrail client, send request, and get info and data
@@ -103,6 +142,79 @@ class Testclient(object):
         rest_uri = 'get_case/{}'.format(case_id)
         return self.send_get(rest_uri)
 
+    def get_attachments(self, entity, entity_id):
+        """
+        get attachment list of entity, entity: case or test (results of a test)
+        """
+        rest_uri = 'get_attachments_for_{}/{}'.format(entity, entity_id)
+        response = self.send_get(rest_uri)
+        if not isinstance(response, dict):
+            return response
+        # paginated response on newer testrail, follow _links.next until it is null
+        attachments = response.get('attachments', [])
+        while response.get('_links', {}).get('next'):
+            rest_uri = response['_links']['next'].split('/api/v2/', 1)[-1]
+            response = self.send_get(rest_uri)
+            attachments += response.get('attachments', [])
+        return attachments
+
+    def add_attachment(self, entity, entity_id, filepath):
+        """
+        upload attachment to entity, entity: case, result, run or plan
+        """
+        rest_uri = 'add_attachment_to_{}/{}'.format(entity, entity_id)
+        return self.send_post(rest_uri, filepath)
+
+    def download_attachment(self, attachment, target_dir):
+        """
+        download one attachment to target_dir, skip it if the file is already
+        there with the same size
+        return saved file path, or None if the download failed
+        """
+        filepath = os.path.join(target_dir, '{}_{}'.format(attachment['id'], attachment['name']))
+        if os.path.isfile(filepath) and os.path.getsize(filepath) == attachment.get('size'):
+            logging.debug('attachment {} already downloaded'.format(attachment['id']))
+            return filepath
+        try:
+            result = self.send_get('get_attachment/{}'.format(attachment['id']), filepath)
+        except Exception as errorinfo:
+            result = errorinfo
+        if result == filepath:
+            return filepath
+        logging.error('attachment {} download fail: {}'.format(attachment['id'], result))
+        # do not leave a partial file that looks like a finished download
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+        return None
+
+    def get_entity_attachments(self, entity):
+        """
+        get attachment list of (entity, entity_id), empty list if the request fails
+        """
+        try:
+            return self.get_attachments(*entity) or []
+        except Exception as errorinfo:
+            logging.error('{} {} get attachments fail: {}'.format(entity[0], entity[1], errorinfo))
+            return []
+
+    def download_attachments(self, target_dir, case_ids=(), test_ids=(), workers=ATTACHMENT_WORKERS):
+        """
+        download all attachments of cases and tests to target_dir concurrently
+        failed downloads are logged and left out, return list of saved file paths
+        """
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        entities = [('case', case_id) for case_id in case_ids] + [('test', test_id) for test_id in test_ids]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            attachment_lists = executor.map(self.get_entity_attachments, entities)
+            attachments = {}
+            for attachment_list in attachment_lists:
+                for attachment in attachment_list:
+                    attachments[attachment['id']] = attachment
+            filepaths = executor.map(lambda attachment: self.download_attachment(attachment, target_dir),
+                                     attachments.values())
+            return [filepath for filepath in filepaths if filepath]
+
     def send_post(self, uri, data):
         """Issue a POST request (write) against the API.
 
@@ -131,16 +243,20 @@ class Testclient(object):
 
         if method == 'POST':
             if uri[:14] == 'add_attachment':    # add_attachment API method
-                files = {'attachment': (open(data, 'rb'))}
-                response = requests.post(url, headers=headers, files=files, verify=False)
-                files['attachment'].close()
+                attachment = AttachmentStream(data)
+                headers['Content-Type'] = attachment.content_type
+                try:
+                    response = requests.post(url, headers=headers, data=attachment, verify=False)
+                finally:
+                    attachment.close()
             else:
                 headers['Content-Type'] = 'application/json'
                 payload = bytes(json.dumps(data), 'utf-8')
                 response = requests.post(url, headers=headers, data=payload, verify=False)
         else:
             headers['Content-Type'] = 'application/json'
-            response = requests.get(url, headers=headers, verify=False)
+            # stream attachment to disk instead of buffering it in memory
+            response = requests.get(url, headers=headers, verify=False, stream=(uri[:15] == 'get_attachment/'))
 
         if response.status_code > 201:
             try:
@@ -151,10 +267,14 @@ class Testclient(object):
         else:
             if uri[:15] == 'get_attachment/':   # Expecting file, not JSON
                 try:
-                    open(data, 'wb').write(response.content)
+                    with open(data, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=ATTACHMENT_CHUNK_SIZE):
+                            f.write(chunk)
                     return (data)
                 except Exception:
                     return ("Error saving attachment.")
+                finally:
+                    response.close()
             else:
                 return response.json()
 
@@ -9,7 +9,10 @@ import json
 import requests
 import logging
 import sys
-from testrail_jira import myjira
+import hashlib
+from urllib.parse import quote
+from xlsxwriter.utility import xl_col_to_name
+from testrail_jira import myjira, AttachmentStream, ATTACHMENT_CHUNK_SIZE
 
 
 # Testrail variables
@@ -24,12 +27,26 @@ testrail_url =
 
 # Const
 os.environ.setdefault("PYTHONHTTPSVERIFY", "0")
-FIRST_BUILD_COLUMN = 7
+FIRST_BUILD_COLUMN = 8
+SIGNATURE_COLUMN = 'Failure signature'
+TOP_SIGNATURES = 50
 VALUABLE_RATE = {"Daily_CI_Redfish": 0.6,
                  "Daily_CI_DAE": 0.8,
                  "Weekly_Stress_DAE": 0.3}
+# builds kept in the working sheets, older build columns go to the job archive
+RETAIN_BUILDS = 60
+ARCHIVE_FOLDER = 'archive'
+BUG_INDEX_FILE = 'jira_bug_index.json'
+JIRA_PAGE_SIZE = 100
+CSV_CHUNK_SIZE = 10000
+BUILD_AGGREGATE_FILE = 'build_aggregate.csv'
 jirafics_dict = {}
 BUG_DICT = {}
+# signature -> failures grouped under it, (job, caseid) -> [build_number, signature]
+FAILURE_SIGNATURES = {}
+CASE_SIGNATURE = {}
+# (job, release, enclosure, rack) -> [builds, pass, fail, skip]
+BUILD_AGGREGATE = {}
 
 
 class Testclient(object):
@@ -78,15 +95,19 @@ class Testclient(object):
 
         if method == 'POST':
             if uri[:14] == 'add_attachment':    # add_attachment API method
-                files = {'attachment': (open(data, 'rb'))}
-                response = requests.post(url, headers=headers, files=files, verify=False)
-                files['attachment'].close()
+                attachment = AttachmentStream(data)
+                headers['Content-Type'] = attachment.content_type
+                try:
+                    response = requests.post(url, headers=headers, data=attachment, verify=False)
+                finally:
+                    attachment.close()
             else:
                 headers['Content-Type'] = 'application/json'
                 response = requests.post(url, headers=headers, data=payload, verify=False)
         else:
             headers['Content-Type'] = 'application/json'
-            response = requests.get(url, headers=headers, verify=False)
+            # stream attachment to disk instead of buffering it in memory
+            response = requests.get(url, headers=headers, verify=False, stream=(uri[:15] == 'get_attachment/'))
 
         if response.status_code > 201:
             try:
@@ -97,10 +118,14 @@ class Testclient(object):
         else:
             if uri[:15] == 'get_attachment/':   # Expecting file, not JSON
                 try:
-                    open(data, 'wb').write(response.content)
+                    with open(data, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=ATTACHMENT_CHUNK_SIZE):
+                            f.write(chunk)
                     return (data)
                 except Exception:
                     return ("Error saving attachment.")
+                finally:
+                    response.close()
             else:
                 return response.json()
 
@@ -124,68 +149,206 @@ def get_case_id_from_string(casename):
         return None
 
 
+def load_bug_index():
+    """
+    load persisted jira bug index, contain last sync time and issue key -> caseid map
+    """
+    index_file = os.path.join(os.path.dirname(final_file), BUG_INDEX_FILE)
+    if os.path.isfile(index_file):
+        with open(index_file, 'r') as f:
+            return json.load(f)
+    return {'last_sync': None, 'issues': {}}
+
+
+def save_bug_index(bug_index):
+    index_file = os.path.join(os.path.dirname(final_file), BUG_INDEX_FILE)
+    with open(index_file, 'w') as f:
+        json.dump(bug_index, f, indent=2, sort_keys=True)
+
+
 def get_bugs_from_jira():
-    JQL = "project = atom and Status != completed and issueType = bug and summary ~ 'CI bug fix'"
-    issuedata = myjira.search_issues(JQL)
-    for issue in issuedata:
-        caseid = get_case_id_from_string(issue.fields.summary)
-        if caseid:
-            BUG_DICT[caseid] = issue.key
+    """
+    sync open 'CI bug fix' bugs into BUG_DICT
+    first run pages through all open bugs, later runs only fetch bugs updated
+    since last sync and drop the ones that became completed
+    """
+    bug_index = load_bug_index()
+    JQL = "project = atom and issueType = bug and summary ~ 'CI bug fix'"
+    if bug_index['last_sync']:
+        JQL += " and updated >= '{}'".format(bug_index['last_sync'])
+    else:
+        JQL += " and Status != completed"
+    # stable paging order, newest updated comes last
+    JQL += " ORDER BY updated ASC, key ASC"
+
+    start_at = 0
+    while True:
+        issuedata = myjira.search_issues(JQL, startAt=start_at, maxResults=JIRA_PAGE_SIZE,
+                                         fields='summary,status,updated')
+        for issue in issuedata:
+            # jira returns updated in the api user timezone, the same one JQL dates use,
+            # so the newest one seen is a safe next sync point whatever the local clock says
+            updated = issue.fields.updated[:16].replace('-', '/').replace('T', ' ')
+            if not bug_index['last_sync'] or updated > bug_index['last_sync']:
+                bug_index['last_sync'] = updated
+            bug_index['issues'].pop(issue.key, None)
+            if issue.fields.status.name.lower() == 'completed':
+                continue
+            caseid = get_case_id_from_string(issue.fields.summary)
+            if caseid:
+                bug_index['issues'][issue.key] = caseid
+        start_at += len(issuedata)
+        if not len(issuedata) or start_at >= issuedata.total:
+            break
+
+    save_bug_index(bug_index)
+    BUG_DICT.clear()
+    # newest bug of a case wins, ATOM-100 is newer than ATOM-99
+    for key in sorted(bug_index['issues'], key=lambda key: int(key.split('-')[-1])):
+        BUG_DICT[bug_index['issues'][key]] = key
+    logging.debug('jira bug index: {} cases'.format(len(BUG_DICT)))
+
+
+def write_column_data(chunksize=CSV_CHUNK_SIZE):
+    """
+    save for new testresult table
+    TestResults.csv is read and test2result.csv is written chunksize rows at a
+    time, so memory is bounded by chunk size rather than file size
+    """
+    header = True
+    for data in pd.read_csv("TestResults.csv", keep_default_na=False, chunksize=chunksize):
+        ten_fail_list = []
+        all_fail_list = []
+        all_run_list = []
+        passrate = []
+        caseid = [get_case_id_from_string(casename) for casename in data['Class']]
+
+        for rowlist in data.itertuples(index=False):
+            ten_fail = 0
+            all_fail = 0
+            all_run = 0
+            current_passrate = 0
+            for result in rowlist[1:]:
+                if result in ['FAILED', 'BLOCKED']:
+                    all_run += 1
+                    all_fail += 1
+                    if all_run < 11:
+                        ten_fail += 1
+                elif result in ['PASSED']:
+                    all_run += 1
+            ten_fail_list.append(ten_fail)
+            all_fail_list.append(all_fail)
+            all_run_list.append(all_run)
+            if all_run:
+                current_passrate = (all_run - all_fail) / all_run
+            passrate.append(current_passrate)
+
+        data.insert(1, "Test Run", all_run_list)
+        data.insert(1, "PassRate", passrate)
+        data.insert(1, "Fail time in last ten runs", ten_fail_list)
+        data.insert(1, "Fail time in all runs", all_fail_list)
+        data.insert(0, "caseid", caseid)
+
+        data.to_csv('test2result.csv', index=False, mode='w' if header else 'a', header=header)
+        header = False
+
+
+def get_archive_file(job_name, kind):
+    """
+    get archive file path of job
+    kind: history (archived case results), builds (archived build info)
+          or aggregate (archived run/fail totals of every case)
+    """
+    archive_folder = os.path.join(os.path.dirname(final_file), ARCHIVE_FOLDER)
+    if not os.path.isdir(archive_folder):
+        os.makedirs(archive_folder)
+    return os.path.join(archive_folder, '{}_{}.csv'.format(job_name, kind))
 
 
-def write_column_data():
-    # save for new testresult table
-    data = pd.read_csv("TestResults.csv", keep_default_na=False,)
-    data.head()
+def load_archive_aggregate(job_name):
+    """
+    load archived totals of job, return {caseid: [all_run, all_fail]}
+    """
+    aggregate = {}
+    aggregate_file = get_archive_file(job_name, 'aggregate')
+    if os.path.isfile(aggregate_file):
+        data = pd.read_csv(aggregate_file, keep_default_na=False)
+        for caseid, all_run, all_fail in zip(data['caseid'], data['all_run'], data['all_fail']):
+            aggregate[caseid] = [int(all_run), int(all_fail)]
+    return aggregate
 
-    caseid = []
-    ten_fail_list = []
-    all_fail_list = []
-    all_run_list = []
-    passrate = []
-    rowlength = len(data.index)
-    for i in range(0, rowlength):
-        casename = data.loc[i].at['Class']
-        caseid.append(get_case_id_from_string(casename))
 
-    for index, row in data.iterrows():
-        rowlist = row.to_list()
-        ten_fail = 0
-        all_fail = 0
-        all_run = 0
-        current_passrate = 0
-        for result in rowlist[1:]:
-            if result in ['FAILED', 'BLOCKED']:
-                all_run += 1
-                all_fail += 1
-                if all_run < 11:
-                    ten_fail += 1
-            elif result in ['PASSED']:
-                all_run += 1
-        ten_fail_list.append(ten_fail)
-        all_fail_list.append(all_fail)
-        all_run_list.append(all_run)
-        if all_run:
-            current_passrate = (all_run - all_fail) / all_run
-        passrate.append(current_passrate)
+def sort_build_columns(datacase):
+    """
+    keep build columns in newest first order
+    """
+    build_columns = sorted(datacase.columns[FIRST_BUILD_COLUMN:], key=int, reverse=True)
+    return datacase[list(datacase.columns[:FIRST_BUILD_COLUMN]) + build_columns]
+
 
-    data.insert(1, "Test Run", all_run_list)
-    data.insert(1, "PassRate", passrate)
-    data.insert(1, "Fail time in last ten runs", ten_fail_list)
-    data.insert(1, "Fail time in all runs", all_fail_list)
-    data.insert(0, "caseid", caseid)
-    # import pdb
-    # pdb.set_trace()
-    # displaying datdf = df.drop('column_name', 1)a frame again - Output 2
-    data.head()
+def archive_old_builds(datacase, databuild, job_name, retain_build=RETAIN_BUILDS):
+    """
+    keep the recent retain_build builds in the working sheets, move older
+    build columns out and fold them into archived totals
+    return the archive of the job, it is written by save_archive only after
+    the workbook is saved, so a failed run never archives the same build twice
+    """
+    datacase = sort_build_columns(datacase)
+    archive = {'aggregate': load_archive_aggregate(job_name), 'history': None, 'builds': None}
+    old_columns = list(datacase.columns[FIRST_BUILD_COLUMN + retain_build:])
+    if not old_columns:
+        return datacase, databuild, archive
+
+    # archived totals only grow, so later runs never re-read the history
+    aggregate = archive['aggregate']
+    old_data = datacase[old_columns]
+    fail_count = old_data.isin(['FAILED', 'BLOCKED']).sum(axis=1)
+    run_count = fail_count + old_data.isin(['PASSED']).sum(axis=1)
+    for caseid, all_run, all_fail in zip(datacase['caseid'], run_count, fail_count):
+        archived = aggregate.setdefault(caseid, [0, 0])
+        archived[0] += int(all_run)
+        archived[1] += int(all_fail)
+
+    archive['history'] = datacase[['caseid'] + old_columns].melt(id_vars='caseid', var_name='build',
+                                                                 value_name='status')
+    datacase = datacase.drop(columns=old_columns)
+
+    oldest_build = int(datacase.columns[-1]) if len(datacase.columns) > FIRST_BUILD_COLUMN else 0
+    old_build_columns = [column for column in databuild.columns[1:] if int(column) < oldest_build]
+    if old_build_columns:
+        builds = databuild.set_index(databuild.columns[0])[old_build_columns].T
+        builds.index.name = 'build'
+        archive['builds'] = builds
+        databuild = databuild.drop(columns=old_build_columns)
+    logging.debug('{}: archived builds {}'.format(job_name, old_columns))
+    return datacase, databuild, archive
+
+
+def save_archive(job_name, archive):
+    """
+    write archived totals and append archived columns to the job archive files
+    """
+    if archive['history'] is None:
+        return
+    aggregate_data = pd.DataFrame([[key] + value for key, value in archive['aggregate'].items()],
+                                  columns=['caseid', 'all_run', 'all_fail'])
+    aggregate_data.to_csv(get_archive_file(job_name, 'aggregate'), index=False)
 
-    data.to_csv('test2result.csv', index=False)
+    history_file = get_archive_file(job_name, 'history')
+    archive['history'].to_csv(history_file, mode='a', header=not os.path.isfile(history_file), index=False)
+    if archive['builds'] is not None:
+        builds_file = get_archive_file(job_name, 'builds')
+        archive['builds'].to_csv(builds_file, mode='a', header=not os.path.isfile(builds_file))
 
 
-def update_analysis_data(dataf, worksheet, recent_build=1024):
+def update_analysis_data(dataf, worksheet, recent_build=1024, archive=None, job_name=None):
     """
     dataf:  dataframe of case
+    job_name:  job of the case sheet, to pick the case signature of this job
     recent_build:  recent build number def
+    archive:  archived totals of the job, {caseid: [all_run, all_fail]}
+              build order is lost in the archive, so archived runs are clamped to
+              what is left of recent_build and archived fails scaled the same way
     """
     all_fail_list = []
     ten_fail_list = []
@@ -193,12 +356,17 @@ def update_analysis_data(dataf, worksheet, recent_build=1024):
     current_passrate_list = []
     all_run_list = []
     jira_list = []
+    signature_list = []
     for index, row in dataf.iterrows():
         rowlist = row.to_list()
-        if jirafics_dict and rowlist[0] in jirafics_dict.keys():
+        if (job_name, rowlist[0]) in CASE_SIGNATURE:
+            signature_list.append(CASE_SIGNATURE[(job_name, rowlist[0])][1])
+        else:
+            signature_list.append(rowlist[FIRST_BUILD_COLUMN - 1])
+        if rowlist[0] in jirafics_dict:
             # worksheet.write("B{}".format(index + 2), jirafics_dict[rowlist[0]])
             jira_list.append(jirafics_dict[rowlist[0]])
-        elif BUG_DICT and rowlist[0] in BUG_DICT.keys():
+        elif rowlist[0] in BUG_DICT:
             jira_list.append(BUG_DICT[rowlist[0]])
         else:
             jira_list.append("no ticket")
@@ -221,6 +389,12 @@ def update_analysis_data(dataf, worksheet, recent_build=1024):
                     thirty_fail += 1
             elif result in ['PASSED']:
                 all_run += 1
+        # add archived builds to all-time totals, up to the recent cap
+        if archive and rowlist[0] in archive and archive[rowlist[0]][0] and all_run < recent_build:
+            archived_run, archived_fail = archive[rowlist[0]]
+            added_run = min(archived_run, recent_build - all_run)
+            all_run += added_run
+            all_fail += int(round(archived_fail * added_run / archived_run))
         if all_run:
             current_passrate = "{:.2%}".format((all_run - all_fail) / all_run)
         all_fail_list.append(all_fail)
@@ -236,6 +410,7 @@ def update_analysis_data(dataf, worksheet, recent_build=1024):
         cell_ten_fail = "E{}".format(i+2)
         cell_passrate = "F{}".format(i+2)
         cell_allrun = "G{}".format(i+2)
+        cell_signature = "H{}".format(i+2)
         if 'ATOM' in jira_list[i]:
             atomurl = '{}'.format(jira_list[i])
             worksheet.write_url(cell_jira_issue, atomurl, string=jira_list[i])
@@ -246,23 +421,177 @@ def update_analysis_data(dataf, worksheet, recent_build=1024):
         worksheet.write(cell_ten_fail, ten_fail_list[i])
         worksheet.write(cell_passrate, current_passrate_list[i])
         worksheet.write(cell_allrun, all_run_list[i])
+        worksheet.write(cell_signature, signature_list[i])
+
+
+def get_job_tree(jenkins_server, job_name, tree):
+    """
+    get only the fields in tree of the job, instead of the full job document
+    """
+    url = '{}job/{}/api/json?tree={}'.format(jenkins_server.server, quote(job_name), quote(tree))
+    return json.loads(jenkins_server.jenkins_open(requests.Request('GET', url)))
 
 
 def get_last_build_number(jenkins_server, job_name):
-    build_info = jenkins_server.get_job_info(name=job_name)
-    # first_build = build_info['firstBuild']['number']
+    build_info = get_job_tree(jenkins_server, job_name, 'lastBuild[number]')
     return build_info['lastBuild']['number']
 
 
-def get_new_build_data(dataframe, cases):
+def get_builds_metadata(jenkins_server, job_name, build_count):
+    """
+    get number/result/timestamp/description/displayName of the recent
+    build_count builds in one request, return {build_number: build_info}
+    builds is capped at 100 entries by jenkins, allBuilds honours the range
+    """
+    tree = 'allBuilds[number,result,timestamp,description,displayName]{{0,{}}}'.format(build_count)
+    job_info = get_job_tree(jenkins_server, job_name, tree)
+    return {build_info['number']: build_info for build_info in job_info.get('allBuilds', [])}
+
+
+def normalize_error_text(error_text):
+    """
+    strip the parts of error text that change between runs:
+    timestamps, hex addresses, uuids and numbers
+    """
+    text = re.sub(r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?', '<time>', error_text)
+    text = re.sub(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', '<uuid>', text, flags=re.I)
+    text = re.sub(r'0x[0-9a-f]+', '<addr>', text, flags=re.I)
+    text = re.sub(r'\d+', '<n>', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def add_failure_signature(caseid, error_text, job_name, build_number):
+    """
+    hash normalized error text into a signature and group the failure under it
+    """
+    normalized = normalize_error_text(error_text)
+    signature = hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+    failure = FAILURE_SIGNATURES.setdefault(signature, {'message': normalized, 'count': 0,
+                                                        'cases': set(), 'builds': set(), 'jobs': set()})
+    failure['count'] += 1
+    failure['cases'].add(caseid)
+    failure['builds'].add(build_number)
+    failure['jobs'].add(job_name)
+    return signature
+
+
+def update_case_signature(job_name, caseid, signature, build_number):
+    """
+    keep signature of the newest build of the case in the job, gap builds may
+    come later, build numbers are only comparable inside one job
+    """
+    key = (job_name, caseid)
+    if build_number is None or build_number >= CASE_SIGNATURE.get(key, [0])[0]:
+        CASE_SIGNATURE[key] = [build_number or 0, signature]
+
+
+def seed_case_signature(datacase, job_name):
+    """
+    start every case from the signature saved in the sheet and its newest local
+    build with a result, so a backfilled older build can not override it
+    """
+    build_columns = list(datacase.columns[FIRST_BUILD_COLUMN:])
+    for caseid, signature, results in zip(datacase['caseid'], datacase[SIGNATURE_COLUMN],
+                                          datacase[build_columns].itertuples(index=False)):
+        local_builds = [int(column) for column, result in zip(build_columns, results)
+                        if not pd.isna(result) and result not in ['N/A', '']]
+        if local_builds:
+            CASE_SIGNATURE[(job_name, caseid)] = [max(local_builds), signature]
+
+
+def ensure_signature_column(datacase):
+    """
+    add signature column to case sheet saved before it existed
+    """
+    if SIGNATURE_COLUMN not in datacase.columns:
+        datacase.insert(FIRST_BUILD_COLUMN - 1, SIGNATURE_COLUMN, '')
+    # empty cells are read back as NaN
+    datacase[SIGNATURE_COLUMN] = datacase[SIGNATURE_COLUMN].fillna('')
+    return datacase
+
+
+def get_build_field(value):
+    """
+    missing jenkins field is None, the same field read back from excel is NaN
+    """
+    if value is None or pd.isna(value):
+        return ''
+    return str(value)
+
+
+def add_build_aggregate(job_name, build_msg):
+    """
+    fold one build into the job/release/enclosure/rack aggregate
+    build_msg: [builddate, release, enclosure, rack, pass_count, fail_count, skip_count, passrate]
+    """
+    key = (job_name, ) + tuple(get_build_field(value) for value in build_msg[1:4])
+    counts = BUILD_AGGREGATE.setdefault(key, [0, 0, 0, 0])
+    counts[0] += 1
+    counts[1] += int(build_msg[4])
+    counts[2] += int(build_msg[5])
+    counts[3] += int(build_msg[6])
+
+
+def load_build_aggregate(job_builds):
+    """
+    load build aggregate, on first run seed it from build sheets and archived builds
+    job_builds: {job_name: databuild}
+    """
+    BUILD_AGGREGATE.clear()
+    aggregate_file = os.path.join(os.path.dirname(final_file), ARCHIVE_FOLDER, BUILD_AGGREGATE_FILE)
+    if os.path.isfile(aggregate_file):
+        data = pd.read_csv(aggregate_file, keep_default_na=False, dtype=str)
+        for row in data.itertuples(index=False):
+            BUILD_AGGREGATE[(row.job, row.release, row.enclosure, row.rack)] = [
+                int(row.builds), int(row.pass_count), int(row.fail_count), int(row.skip_count)]
+        return
+
+    for job_name, databuild in job_builds.items():
+        for column in databuild.columns[1:]:
+            add_build_aggregate(job_name, databuild[column].tolist())
+        builds_file = get_archive_file(job_name, 'builds')
+        if os.path.isfile(builds_file):
+            builds = pd.read_csv(builds_file, index_col=0)
+            for build_msg in builds.itertuples(index=False):
+                add_build_aggregate(job_name, list(build_msg))
+
+
+def save_build_aggregate():
+    aggregate_file = os.path.join(os.path.dirname(final_file), ARCHIVE_FOLDER, BUILD_AGGREGATE_FILE)
+    if not os.path.isdir(os.path.dirname(aggregate_file)):
+        os.makedirs(os.path.dirname(aggregate_file))
+    get_build_aggregate_sheet_data().drop(columns=['passrate']).to_csv(aggregate_file, index=False)
+
+
+def get_build_aggregate_sheet_data():
+    """
+    pass rate of every job/release/enclosure/rack from the aggregate
+    """
+    rows = []
+    for key, counts in sorted(BUILD_AGGREGATE.items()):
+        total = counts[1] + counts[2] + counts[3]
+        passrate = "{:.2%}".format((counts[1] + counts[3]) / total) if total else 0
+        rows.append(list(key) + counts + [passrate])
+    return pd.DataFrame(rows, columns=['job', 'release', 'enclosure', 'rack', 'builds',
+                                       'pass_count', 'fail_count', 'skip_count', 'passrate'])
+
+
+def get_new_build_data(dataframe, cases, job_name=None, build_number=None):
     """
     get cases result and check if there is new cases
+    failed cases are grouped by failure signature of their errorDetails
     """
     cases_map = {}
     build_list = []
     for case in cases:
         caseid = get_case_id_from_string(case['name'])
         cases_map[caseid] = case['status']
+        if caseid and case['status'] in ['FAILED', 'REGRESSION'] and case['errorDetails']:
+            signature = add_failure_signature(caseid, case['errorDetails'], job_name, build_number)
+            update_case_signature(job_name, caseid, signature, build_number)
+        elif caseid and case['status'] in ['FAILED', 'REGRESSION', 'PASSED', 'FIXED']:
+            # passed, or failed without error text: old signature no longer applies
+            update_case_signature(job_name, caseid, '', build_number)
         if case['errorDetails']:
             searchObj = re.search('(JIRAFICS-[0-9]{2,20})', case['errorDetails'], re.M|re.I)
             if searchObj:
@@ -289,98 +618,113 @@ def get_new_build_data(dataframe, cases):
     return build_list, cases_map
 
 
-def update_case_sheet_data(jenkins_server, datacase, databuild, job_name, valid_buid):
-    last_build_jenkens = get_last_build_number(jenkins_server, job_name)
-    new_build_list = []
-    last_buid_in_local = int(datacase.columns[FIRST_BUILD_COLUMN])
-    if (last_build_jenkens > last_buid_in_local):
-        for i in range(last_buid_in_local + 1, last_build_jenkens + 1):
-            build_number = i
-            # if build number can not find in jenkens , it will return None
-            build_test_result = jenkins_server.get_build_test_report(name=job_name, number=build_number)
-            if build_test_result and len(build_test_result['suites'][0]['cases']) > valid_buid:
-                build_info = jenkins_server.get_build_info(name=job_name, number=build_number)
-
-                release = build_info["description"]
-                enclosure = build_info["displayName"].split(" ")[4]
-                rack = build_info["displayName"].split(" ")[5]
-                pass_count = build_test_result["passCount"]
-                fail_count = build_test_result["failCount"]
-                skip_count = build_test_result["skipCount"]
-                float_passrate = (float)(pass_count + skip_count) / (pass_count + fail_count + skip_count)
-                # valuable build passrate
-                if float_passrate < VALUABLE_RATE[job_name]:
-                    continue
-                # TODO  wait for fkp2 fixed
-                if "fkp2" in enclosure:
-                    continue
-                passrate = "{:.2%}".format(float_passrate)
-
-                builddate = datetime.datetime.fromtimestamp(build_info['timestamp'] / 1e3)
-                builddate = builddate.date()
-                build_msg = [builddate, release, enclosure, rack, pass_count, fail_count, skip_count, passrate]
-                databuild.insert(1, build_number, build_msg)
-
-                if build_test_result['suites'][0]['cases']:
-                    new_build_list, new_cases_info = get_new_build_data(datacase, build_test_result['suites'][0]['cases'])
-                    datacase.insert(FIRST_BUILD_COLUMN, build_number, new_build_list)
-                    if new_cases_info:
-                        for key in new_cases_info:
-                            new_case = {}
-                            new_case['caseid'] = key
-                            new_case[build_number] = new_cases_info[key]
-                            datacase = datacase.append(new_case, ignore_index=True)
-
-    datacase = datacase.fillna('N/A')
-    datacase = datacase.sort_values('caseid')
-    return datacase, databuild
+def load_skipped_builds(job_name):
+    """
+    load builds already checked and skipped, return {build_number: reason}
+    """
+    skipped_builds = {}
+    skipped_file = get_archive_file(job_name, 'skipped')
+    if os.path.isfile(skipped_file):
+        data = pd.read_csv(skipped_file, keep_default_na=False)
+        for build_number, reason in zip(data['build'], data['reason']):
+            skipped_builds[int(build_number)] = reason
+    return skipped_builds
 
 
-def check_miss_build(jenkins_server, datacase, databuild, job_name, valid_buid):
-    last_build = int(datacase.columns[FIRST_BUILD_COLUMN])
-    for build_number in range(last_build - 6, last_build):
-        if build_number in datacase.columns[FIRST_BUILD_COLUMN:(FIRST_BUILD_COLUMN + 6)]:
+def save_skipped_builds(job_name, skipped_builds, first_build):
+    """
+    save skipped builds, builds older than the retained range are dropped
+    """
+    skipped_data = pd.DataFrame(sorted((build_number, reason) for build_number, reason in skipped_builds.items()
+                                       if build_number >= first_build),
+                                columns=['build', 'reason'])
+    skipped_data.to_csv(get_archive_file(job_name, 'skipped'), index=False)
+
+
+def ingest_builds(jenkins_server, datacase, databuild, job_name, valid_buid):
+    """
+    fetch every build missing from the retained range in one pass
+    missing builds are the set difference of all build numbers from the oldest
+    local build to the last jenkins build, minus case sheet and skipped builds;
+    a build already in the build sheet gets its case column filled and its
+    build column replaced; skip reasons are saved so those builds are not
+    fetched again, only builds still running are retried next run
+    """
+    last_build_jenkens = get_last_build_number(jenkins_server, job_name)
+    local_builds = set(int(column) for column in datacase.columns[FIRST_BUILD_COLUMN:])
+    skipped_builds = load_skipped_builds(job_name)
+    seed_case_signature(datacase, job_name)
+    first_build = min(local_builds) if local_builds else last_build_jenkens
+    missing_builds = set(range(first_build, last_build_jenkens + 1)) - local_builds - set(skipped_builds)
+    logging.debug('{}: missing builds {}'.format(job_name, sorted(missing_builds)))
+    sheet_builds = {int(column): column for column in databuild.columns[1:]}
+    builds_metadata = {}
+    if missing_builds:
+        # allBuilds list is newest first, first_build is at most this far from the top
+        builds_metadata = get_builds_metadata(jenkins_server, job_name, last_build_jenkens - first_build + 1)
+
+    for build_number in sorted(missing_builds):
+        build_info = builds_metadata.get(build_number)
+        if not build_info:
+            skipped_builds[build_number] = 'no build'
             continue
+        # build still running
+        if not build_info['result']:
+            continue
+        # if build number can not find in jenkens , it will return None
+        build_test_result = jenkins_server.get_build_test_report(name=job_name, number=build_number)
+        if not build_test_result:
+            skipped_builds[build_number] = 'no test report'
+            continue
+        cases = build_test_result['suites'][0]['cases']
+        if len(cases) <= valid_buid:
+            skipped_builds[build_number] = 'too few cases'
+            continue
+
+        release = build_info["description"]
+        enclosure = build_info["displayName"].split(" ")[4]
+        rack = build_info["displayName"].split(" ")[5]
+        pass_count = build_test_result["passCount"]
+        fail_count = build_test_result["failCount"]
+        skip_count = build_test_result["skipCount"]
+        float_passrate = (float)(pass_count + skip_count) / (pass_count + fail_count + skip_count)
+        # valuable build passrate
+        if float_passrate < VALUABLE_RATE[job_name]:
+            skipped_builds[build_number] = 'below valuable rate'
+            continue
+        # TODO  wait for fkp2 fixed, then drop 'enclosure filter' rows from skipped file
+        if "fkp2" in enclosure:
+            skipped_builds[build_number] = 'enclosure filter'
+            continue
+        passrate = "{:.2%}".format(float_passrate)
+
+        builddate = datetime.datetime.fromtimestamp(build_info['timestamp'] / 1e3)
+        builddate = builddate.date()
+        build_msg = [builddate, release, enclosure, rack, pass_count, fail_count, skip_count, passrate]
+        if build_number in sheet_builds:
+            # already counted in the aggregate when it first went to the build sheet
+            databuild[sheet_builds[build_number]] = build_msg
         else:
-            build_test_result = jenkins_server.get_build_test_report(name=job_name, number=build_number)
-            if build_test_result and len(build_test_result['suites'][0]['cases']) > valid_buid:
-                build_info = jenkins_server.get_build_info(name=job_name, number=build_number)
-
-                release = build_info["description"]
-                enclosure = build_info["displayName"].split(" ")[4]
-                rack = build_info["displayName"].split(" ")[5]
-                pass_count = build_test_result["passCount"]
-                fail_count = build_test_result["failCount"]
-                skip_count = build_test_result["skipCount"]
-                float_passrate = (float)(pass_count + skip_count) / (pass_count + fail_count + skip_count)
-                # valuable build passrate
-                if float_passrate < VALUABLE_RATE[job_name]:
-                    continue
-                # TODO  wait for fkp2 fixed
-                if "fkp2" in enclosure:
-                    continue
-                passrate = "{:.2%}".format(float_passrate)
-
-                builddate = datetime.datetime.fromtimestamp(build_info['timestamp'] / 1e3)
-                builddate = builddate.date()
-                build_msg = [builddate, release, enclosure, rack, pass_count, fail_count, skip_count, passrate]
-                databuild.insert(1, build_number, build_msg)
-
-                if build_test_result['suites'][0]['cases']:
-                    new_build_list, new_cases_info = get_new_build_data(datacase, build_test_result['suites'][0]['cases'])
-                    datacase.insert(FIRST_BUILD_COLUMN, build_number, new_build_list)
-                    if new_cases_info:
-                        for key in new_cases_info:
-                            new_case = {}
-                            new_case['caseid'] = key
-                            new_case[build_number] = new_cases_info[key]
-                            datacase = datacase.append(new_case, ignore_index=True)
-    datacase = datacase.fillna('N/A')
+            databuild.insert(1, build_number, build_msg)
+            add_build_aggregate(job_name, build_msg)
+
+        new_build_list, new_cases_info = get_new_build_data(datacase, cases, job_name, build_number)
+        datacase.insert(FIRST_BUILD_COLUMN, build_number, new_build_list)
+        if new_cases_info:
+            for key in new_cases_info:
+                new_case = {}
+                new_case['caseid'] = key
+                new_case[build_number] = new_cases_info[key]
+                datacase = datacase.append(new_case, ignore_index=True)
+
+    save_skipped_builds(job_name, skipped_builds, first_build)
+    datacase = sort_build_columns(datacase.fillna('N/A'))
     datacase = datacase.sort_values('caseid')
     return datacase, databuild
 
 
-def update_excel_and_fill_na(jenkins_server, job_name='Daily_CI_DAE', buildtime=1024, valid_buid=100):
+def update_excel_and_fill_na(jenkins_server, job_name='Daily_CI_DAE', buildtime=1024, valid_buid=100,
+                             retain_build=RETAIN_BUILDS):
     # dataf = pd.read_csv("case1test.csv", keep_default_na=False)
     # new_info = {'caseid': 'C1200000', '134': 'PASSED'}
     # dataf = dataf.append(new_info, ignore_index=True)
@@ -398,15 +742,20 @@ def update_excel_and_fill_na(jenkins_server, job_name='Daily_CI_DAE', buildtime=
     redfishdatabuild = all_data.parse('redfishbuildinfo')
     daestresscase = all_data.parse('daestresscase')
     daestressbuild = all_data.parse('daestressbuild')
+    datacase = ensure_signature_column(datacase)
+    redfishdatacase = ensure_signature_column(redfishdatacase)
+    daestresscase = ensure_signature_column(daestresscase)
+    load_build_aggregate({"Daily_CI_DAE": databuild,
+                          "Daily_CI_Redfish": redfishdatabuild,
+                          "Weekly_Stress_DAE": daestressbuild})
 
+    datacase, databuild = ingest_builds(jenkins_server, datacase, databuild, "Daily_CI_DAE", 100)
+    redfishdatacase, redfishdatabuild = ingest_builds(jenkins_server, redfishdatacase, redfishdatabuild, "Daily_CI_Redfish", 30)
+    daestresscase, daestressbuild = ingest_builds(jenkins_server, daestresscase, daestressbuild, "Weekly_Stress_DAE", 6)
 
-    datacase, databuild = update_case_sheet_data(jenkins_server, datacase, databuild, "Daily_CI_DAE", 100)
-    redfishdatacase, redfishdatabuild = update_case_sheet_data(jenkins_server, redfishdatacase, redfishdatabuild, "Daily_CI_Redfish", 30)
-    daestresscase, daestressbuild = update_case_sheet_data(jenkins_server, daestresscase, daestressbuild, "Weekly_Stress_DAE", 6)
-
-    datacase, databuild = check_miss_build(jenkins_server, datacase, databuild, "Daily_CI_DAE", 100)
-    redfishdatacase, redfishdatabuild = check_miss_build(jenkins_server, redfishdatacase, redfishdatabuild, "Daily_CI_Redfish", 30)
-    daestresscase, daestressbuild = check_miss_build(jenkins_server, daestresscase, daestressbuild, "Weekly_Stress_DAE", 6)
+    datacase, databuild, dae_archive = archive_old_builds(datacase, databuild, "Daily_CI_DAE", retain_build)
+    redfishdatacase, redfishdatabuild, redfish_archive = archive_old_builds(redfishdatacase, redfishdatabuild, "Daily_CI_Redfish", retain_build)
+    daestresscase, daestressbuild, daestress_archive = archive_old_builds(daestresscase, daestressbuild, "Weekly_Stress_DAE", retain_build)
 
     dae_sheet_info, dpe_sheet_info = get_backlog_cases_sheet_info()
     writer = pd.ExcelWriter(final_file, engine='xlsxwriter')
@@ -421,17 +770,19 @@ def update_excel_and_fill_na(jenkins_server, job_name='Daily_CI_DAE', buildtime=
     daestresscase.to_excel(writer, sheet_name='daestresscase', index=False)
     daestressbuild.to_excel(writer, sheet_name='daestressbuild', index=False)
     backloginfo.to_excel(writer, sheet_name='Backlog Case Number', index=False)
+    get_signature_sheet_data().to_excel(writer, sheet_name='failuresignature', index=False)
+    get_build_aggregate_sheet_data().to_excel(writer, sheet_name='buildaggregate', index=False)
 
     worksheet1 = writer.sheets['daecaseinfo']
-    update_analysis_data(datacase, worksheet1, buildtime)
+    update_analysis_data(datacase, worksheet1, buildtime, dae_archive['aggregate'], "Daily_CI_DAE")
 
     worksheet2 = writer.sheets['redfishcaseinfo']
-    update_analysis_data(redfishdatacase, worksheet2, buildtime)
+    update_analysis_data(redfishdatacase, worksheet2, buildtime, redfish_archive['aggregate'], "Daily_CI_Redfish")
 
     worksheet3 = writer.sheets['Backlog Case Number']
 
     worksheet4 = writer.sheets['daestresscase']
-    update_analysis_data(daestresscase, worksheet4, buildtime)
+    update_analysis_data(daestresscase, worksheet4, buildtime, daestress_archive['aggregate'], "Weekly_Stress_DAE")
 
     for i in range(len(dae_sheet_info)):
         cell = 'B{}'.format(i+3)
@@ -452,47 +803,67 @@ def update_excel_and_fill_na(jenkins_server, job_name='Daily_CI_DAE', buildtime=
     format3 = workbook.add_format({'bg_color':   '#C6EFCE',
                                    'font_color': '#006100'})
 
-    for nworksheet in [worksheet1, worksheet2, worksheet4]:
+    for nworksheet, ndatacase in [(worksheet1, datacase), (worksheet2, redfishdatacase), (worksheet4, daestresscase)]:
+        # the working set is bounded by retain_build, so ranges follow the sheet size
+        last_row = len(ndatacase.index) + 1
+        build_range = 'G2:{}{}'.format(xl_col_to_name(len(ndatacase.columns) - 1), last_row)
         # Apply a conditional format to the cell range.
         # worksheet.conditional_format('G2:BB151', {'type': '3_color_scale'})
-        nworksheet.conditional_format('G2:CA300', {'type':     'text',
-                                                   'criteria': 'containing',
-                                                   'value':    'PASSED',
-                                                   'format':   format3})
-        nworksheet.conditional_format('G2:CA300', {'type':     'text',
-                                                   'criteria': 'containing',
-                                                   'value':    'SKIPPED',
-                                                   'format':   format2})
-        nworksheet.conditional_format('G2:EE300', {'type':     'text',
-                                                   'criteria': 'containing',
-                                                   'value':    'FAILED',
-                                                   'format':   format1})
-
-        nworksheet.conditional_format('B2:B1000', {'type':     'text',
-                                                   'criteria': 'containing',
-                                                   'value':    'fixed',
-                                                   'format':   format1})
-        nworksheet.conditional_format('B2:B1000', {'type':     'text',
-                                                   'criteria': 'containing',
-                                                   'value':    'known',
-                                                   'format':   format2})
-        nworksheet.conditional_format('B2:B1000', {'type':     'text',
-                                                   'criteria': 'containing',
-                                                   'value':    'ATOM',
-                                                   'format':   format2})
-        nworksheet.conditional_format('E2:E1000', {'type':     'cell',
-                                                   'criteria': '>',
-                                                   'value':    1,
-                                                   'format':   format1})
+        nworksheet.conditional_format(build_range, {'type':     'text',
+                                                    'criteria': 'containing',
+                                                    'value':    'PASSED',
+                                                    'format':   format3})
+        nworksheet.conditional_format(build_range, {'type':     'text',
+                                                    'criteria': 'containing',
+                                                    'value':    'SKIPPED',
+                                                    'format':   format2})
+        nworksheet.conditional_format(build_range, {'type':     'text',
+                                                    'criteria': 'containing',
+                                                    'value':    'FAILED',
+                                                    'format':   format1})
+
+        nworksheet.conditional_format('B2:B{}'.format(last_row), {'type':     'text',
+                                                                  'criteria': 'containing',
+                                                                  'value':    'fixed',
+                                                                  'format':   format1})
+        nworksheet.conditional_format('B2:B{}'.format(last_row), {'type':     'text',
+                                                                  'criteria': 'containing',
+                                                                  'value':    'known',
+                                                                  'format':   format2})
+        nworksheet.conditional_format('B2:B{}'.format(last_row), {'type':     'text',
+                                                                  'criteria': 'containing',
+                                                                  'value':    'ATOM',
+                                                                  'format':   format2})
+        nworksheet.conditional_format('E2:E{}'.format(last_row), {'type':     'cell',
+                                                                  'criteria': '>',
+                                                                  'value':    1,
+                                                                  'format':   format1})
 
     writer.save()
+    # aggregate and archive files only follow a saved workbook, otherwise the
+    # next run ingests or archives the same builds again and counts them twice
+    save_build_aggregate()
+    save_archive("Daily_CI_DAE", dae_archive)
+    save_archive("Daily_CI_Redfish", redfish_archive)
+    save_archive("Weekly_Stress_DAE", daestress_archive)
+
+
+def get_signature_sheet_data(top=TOP_SIGNATURES):
+    """
+    top failure signatures of the builds ingested in this run, most failures first
+    """
+    rows = []
+    for signature, failure in sorted(FAILURE_SIGNATURES.items(), key=lambda item: item[1]['count'], reverse=True)[:top]:
+        rows.append([signature, failure['count'], len(failure['cases']), len(failure['builds']),
+                     ', '.join(sorted(failure['jobs'])), ', '.join(sorted(failure['cases'])),
+                     failure['message'][:1000]])
+    return pd.DataFrame(rows, columns=['signature', 'failures', 'cases', 'builds', 'jobs', 'case list', 'error'])
 
 
 def get_position(column_list, datacase):
     position_list = []
     for column_value in column_list:
         intloc = datacase.columns.get_loc(column_value)
-        from xlsxwriter.utility import xl_col_to_name
         position = '{}2'.format(xl_col_to_name(intloc))
         position_list.append(position)
     return position_list
@@ -585,16 +956,20 @@ if __name__ == '__main__':
     parser.add_argument("-j", "--job", type=str, help="job name of the build")
     parser.add_argument("-f", "--fname", type=str,  help="file name of source excel")
     parser.add_argument("-b", "--backlog", help="backlog case analysis")
+    parser.add_argument("-r", "--retain", type=int, help="number of recent builds kept in the report sheets")
     commandList = parser.parse_args()
     nbuild = 1024
     RESULT_FILE = "case_analysis_result.xlsx"
     valid_build = 100
+    retain_build = RETAIN_BUILDS
     if commandList.fname:
         RESULT_FILE = commandList.fname
     if commandList.nbuild:
         nbuild = commandList.nbuild
     if commandList.valid:
         valid_build = commandList.valid
+    if commandList.retain:
+        retain_build = commandList.retain
     if not commandList.job:
         job_name = 'Daily_CI_DAE'
     else:
@@ -605,5 +980,5 @@ if __name__ == '__main__':
     final_file = os.path.join(THIS_FOLDER, RESULT_FILE)
     get_bugs_from_jira()
 
-    update_excel_and_fill_na(jenkins_server, job_name, nbuild, valid_build)
+    update_excel_and_fill_na(jenkins_server, job_name, nbuild, valid_build, retain_build)
     print(jirafics_dict)